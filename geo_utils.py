@@ -0,0 +1,93 @@
+"""
+geo_utils.py
+
+Geometry helpers for plantation geometries (lon/lat, WGS84): building them from
+kml_parser geometry dicts, geodesic measurements and bounds.
+Areas and lengths are computed on the WGS84 ellipsoid with pyproj.Geod,
+instead of scaling planar degree measurements by a metres-per-degree constant.
+"""
+
+import numpy as np
+import shapely
+from pyproj import Geod
+from shapely.geometry import LineString, Point, Polygon
+
+GEOD = Geod(ellps="WGS84")
+
+
+def calculate_area(geom) -> float:
+    """Return the geodesic area of a Polygon in square metres (0 for other geometries)."""
+    if isinstance(geom, Polygon):
+        area, _ = GEOD.geometry_area_perimeter(geom)
+        # the sign only reflects ring orientation
+        return abs(area)
+    return 0
+
+
+def calculate_length(geom) -> float:
+    """Return the geodesic length of a LineString, or perimeter of a Polygon, in metres."""
+    if isinstance(geom, (LineString, Polygon)):
+        return GEOD.geometry_length(geom)
+    return 0
+
+
+def total_bounds(geoms):
+    """
+    Return (min_lon, min_lat, max_lon, max_lat) enclosing all geometries,
+    or None if there are none (or all are empty).
+    """
+    # shapely.bounds is vectorised: one (N, 4) array from a single GEOS call
+    return bounds_extent(shapely.bounds(np.asarray(geoms, dtype=object).reshape(-1)))
+
+
+def bounds_extent(bounds):
+    """
+    Reduce an (N, 4) array of per-geometry bounds to the enclosing
+    (min_lon, min_lat, max_lon, max_lat), or None if there are no (non-empty) rows.
+    """
+    bounds = bounds[~np.isnan(bounds).any(axis=1)]
+    if not len(bounds):
+        return None
+    return tuple(np.concatenate([bounds[:, :2].min(axis=0), bounds[:, 2:].max(axis=0)]).tolist())
+
+
+def _xy(coords):
+    """Return an (N, 2) float array of the lon/lat of kml_parser coordinate tuples."""
+    try:
+        # one C-level conversion when every vertex has the same dimension
+        return np.asarray(coords, dtype=float)[:, :2]
+    except ValueError:
+        # ragged: a ring mixing (lon, lat) and (lon, lat, alt) vertices
+        return np.array([c[:2] for c in coords], dtype=float)
+
+
+def geometry_from_kml(geom_dict):
+    """Build a 2D Shapely geometry from a kml_parser geometry dict (None for unsupported types)."""
+    geom_type = geom_dict.get('type')
+    if geom_type == 'Polygon':
+        coords = geom_dict['coordinates']
+        return Polygon(_xy(coords['outer']), [_xy(hole) for hole in coords['holes']])
+    if geom_type == 'LineString':
+        return LineString(_xy(geom_dict['coordinates']))
+    if geom_type == 'Point':
+        coords = geom_dict['coordinates']
+        return Point(coords[0], coords[1])
+    return None
+
+
+def build_measured_geometry(geom_dict):
+    """
+    Build and measure the geometry for a kml_parser geometry dict.
+
+    Returns (geometry, area_sq_m, length_m, error). geometry is None for
+    unsupported types, or when construction fails, in which case error holds the
+    message. Errors are returned rather than raised so a bad geometry doesn't
+    abort a whole ProcessPoolExecutor.map.
+    """
+    try:
+        geom = geometry_from_kml(geom_dict)
+        if geom is None:
+            return None, 0, 0, None
+        return geom, calculate_area(geom), calculate_length(geom), None
+    except Exception as e:
+        return None, 0, 0, str(e)
@@ -3,13 +3,24 @@ kml_parser.py  (fixed)
 
 More robustly parse KML / KMZ and extract geometry (Point, LineString, Polygon).
 Works around namespace issues by matching element *local-names* (ignoring namespaces).
+Placemarks are extracted in a single streaming pass (iterparse) over the document.
 """
 
+import codecs
+import io
 import sys
 import json
 import zipfile
-import xml.etree.ElementTree as ET
-from typing import List, Dict, Tuple, Optional
+import xml.etree.ElementTree as StdET
+from typing import BinaryIO, List, Dict, Tuple, Optional, Union
+
+try:
+    # libxml2-backed parsing; same Element / iterparse API as the stdlib module
+    from lxml import etree as ET
+    HAVE_LXML = True
+except ImportError:
+    ET = StdET
+    HAVE_LXML = False
 
 
 def read_kml_from_path(path: str) -> str:
@@ -29,24 +40,8 @@ def read_kml_from_path(path: str) -> str:
 
 def strip_namespace(tag: str) -> str:
     """Remove namespace from an XML tag like '{...}tag' -> 'tag'"""
-    return tag.split('}', 1)[-1] if '}' in tag else tag
-
-
-def find_first_local(root: ET.Element, local_name: str) -> Optional[ET.Element]:
-    """Return first element (depth-first) whose local-name matches local_name."""
-    for el in root.iter():
-        if strip_namespace(el.tag) == local_name:
-            return el
-    return None
-
-
-def findall_local(root: ET.Element, local_name: str) -> List[ET.Element]:
-    """Return all elements whose local-name matches local_name."""
-    matches = []
-    for el in root.iter():
-        if strip_namespace(el.tag) == local_name:
-            matches.append(el)
-    return matches
+    # rpartition returns the whole tag as the last item when there is no '}'
+    return tag.rpartition('}')[2]
 
 
 def parse_coordinates_text(text: Optional[str]) -> List[Tuple[float, float, Optional[float]]]:
@@ -56,109 +51,252 @@ def parse_coordinates_text(text: Optional[str]) -> List[Tuple[float, float, Opti
     """
     if text is None:
         return []
-    text = text.strip()
-    if not text:
-        return []
-    parts = text.replace('\n', ' ').split()
     coords = []
-    for p in parts:
+    append = coords.append
+    # str.split() with no separator already splits on (and drops) any whitespace run
+    for p in text.split():
         comps = p.split(',')
-        if len(comps) >= 2:
-            try:
-                lon = float(comps[0])
-                lat = float(comps[1])
-                alt = float(comps[2]) if len(comps) >= 3 and comps[2] != '' else None
-                coords.append((lon, lat, alt))
-            except ValueError:
-                # skip malformed coordinate token
-                continue
+        n = len(comps)
+        if n < 2:
+            continue
+        try:
+            if n >= 3 and comps[2]:
+                append((float(comps[0]), float(comps[1]), float(comps[2])))
+            else:
+                append((float(comps[0]), float(comps[1]), None))
+        except ValueError:
+            # skip malformed coordinate token
+            continue
     return coords
 
 
-def geometry_from_placemark(placemark_el: ET.Element) -> List[Dict]:
+def _local_coords(coords: List[Tuple[float, float, Optional[float]]]) -> List[Tuple]:
+    """Drop the altitude component from coordinate tuples that don't carry one."""
+    return [(lon, lat) if alt is None else (lon, lat, alt) for lon, lat, alt in coords]
+
+
+# Local tag names the Placemark builder reacts to; every other element is skipped
+# with a single set lookup instead of walking the builder's dispatch chain.
+GEOMETRY_START_TAGS = frozenset({'Point', 'LineString', 'Polygon',
+                                 'outerBoundaryIs', 'innerBoundaryIs', 'LinearRing'})
+PLACEMARK_END_TAGS = GEOMETRY_START_TAGS | {'coordinates', 'name', 'description'}
+
+
+class _PlacemarkBuilder:
     """
-    Extract geometry dicts from a Placemark element.
-    Each geometry dict: {'type': 'Point'|'LineString'|'Polygon', 'coordinates': ...}
+    Accumulate one Placemark from a stream of start/end tag events.
+
+    Geometry elements are tracked on a small frame stack, so each <coordinates>
+    is attached to its nearest enclosing Point / LineString / LinearRing without
+    re-scanning the subtree. Geometries are emitted grouped as Points, then
+    LineStrings, then Polygons.
     """
-    geoms: List[Dict] = []
-
-    # POINTS
-    for point_el in findall_local(placemark_el, 'Point'):
-        coords_el = find_first_local(point_el, 'coordinates')
-        coords = parse_coordinates_text(coords_el.text if coords_el is not None else None)
-        if coords:
-            lon, lat, alt = coords[0]
-            geoms.append({'type': 'Point', 'coordinates': (lon, lat) if alt is None else (lon, lat, alt)})
-
-    # LINESTRINGS
-    for ls_el in findall_local(placemark_el, 'LineString'):
-        coords_el = find_first_local(ls_el, 'coordinates')
-        coords = parse_coordinates_text(coords_el.text if coords_el is not None else None)
-        if coords:
-            geoms.append({'type': 'LineString',
-                          'coordinates': [(lon, lat) if alt is None else (lon, lat, alt)
-                                          for lon, lat, alt in coords]})
-
-    # POLYGONS
-    for poly_el in findall_local(placemark_el, 'Polygon'):
+
+    def __init__(self):
+        self.name: Optional[str] = None
+        self.description: Optional[str] = None
+        self._has_name = False
+        self._has_description = False
+        self._frames: List[Dict] = []
+        self._points: List[Dict] = []
+        self._linestrings: List[Dict] = []
+        self._polygons: List[Dict] = []
+
+    def start(self, tag: str) -> None:
+        if tag in ('Point', 'LineString'):
+            self._frames.append({'type': tag, 'coords': None})
+        elif tag == 'Polygon':
+            self._frames.append({'type': tag, 'rings': [], 'boundary': None, 'has_outer': False})
+        elif tag in ('outerBoundaryIs', 'innerBoundaryIs'):
+            poly = self._frames[-1] if self._frames else None
+            if poly is not None and poly['type'] == 'Polygon':
+                # only the first outerBoundaryIs counts as the outer ring
+                role = 'inner' if tag == 'innerBoundaryIs' else (None if poly['has_outer'] else 'outer')
+                poly['has_outer'] = poly['has_outer'] or tag == 'outerBoundaryIs'
+                poly['boundary'] = {'role': role, 'has_ring': False}
+        elif tag == 'LinearRing':
+            poly = self._frames[-1] if self._frames else None
+            role = None
+            if poly is not None and poly['type'] == 'Polygon' and poly['boundary'] is not None:
+                boundary = poly['boundary']
+                # only the first LinearRing of a boundary is used for that boundary
+                role = None if boundary['has_ring'] else boundary['role']
+                boundary['has_ring'] = True
+            self._frames.append({'type': tag, 'coords': None, 'role': role})
+
+    def end(self, tag: str, text: Optional[str]) -> None:
+        if tag == 'coordinates':
+            frame = self._frames[-1] if self._frames else None
+            if frame is not None and frame['type'] != 'Polygon' and frame['coords'] is None:
+                frame['coords'] = parse_coordinates_text(text)
+        elif tag == 'name':
+            if not self._has_name:
+                self._has_name = True
+                self.name = text.strip() if text else None
+        elif tag == 'description':
+            if not self._has_description:
+                self._has_description = True
+                self.description = text.strip() if text else None
+        elif tag == 'Point':
+            coords = self._frames.pop()['coords']
+            if coords:
+                lon, lat, alt = coords[0]
+                self._points.append({'type': 'Point', 'coordinates': (lon, lat) if alt is None else (lon, lat, alt)})
+        elif tag == 'LineString':
+            coords = self._frames.pop()['coords']
+            if coords:
+                self._linestrings.append({'type': 'LineString', 'coordinates': _local_coords(coords)})
+        elif tag == 'LinearRing':
+            ring = self._frames.pop()
+            if self._frames and self._frames[-1]['type'] == 'Polygon':
+                self._frames[-1]['rings'].append(ring)
+        elif tag in ('outerBoundaryIs', 'innerBoundaryIs'):
+            if self._frames and self._frames[-1]['type'] == 'Polygon':
+                self._frames[-1]['boundary'] = None
+        elif tag == 'Polygon':
+            self._close_polygon(self._frames.pop())
+
+    def _close_polygon(self, poly: Dict) -> None:
+        rings = poly['rings']
         outer_coords = []
-        holes: List[List] = []
-
-        # Try to explicitly find outerBoundaryIs / innerBoundaryIs
-        outer_boundary = find_first_local(poly_el, 'outerBoundaryIs')
-        if outer_boundary is not None:
-            lr = find_first_local(outer_boundary, 'LinearRing')
-            if lr is not None:
-                coords_el = find_first_local(lr, 'coordinates')
-                coords = parse_coordinates_text(coords_el.text if coords_el is not None else None)
-                if coords:
-                    outer_coords = [(lon, lat) if alt is None else (lon, lat, alt) for lon, lat, alt in coords]
-
-        # inner boundaries (holes) — there can be multiple
-        for inner_boundary in findall_local(poly_el, 'innerBoundaryIs'):
-            lr = find_first_local(inner_boundary, 'LinearRing')
-            if lr is not None:
-                coords_el = find_first_local(lr, 'coordinates')
-                coords = parse_coordinates_text(coords_el.text if coords_el is not None else None)
-                if coords:
-                    holes.append([(lon, lat) if alt is None else (lon, lat, alt) for lon, lat, alt in coords])
-
-        # Fallback: if above didn't find outer coords, try any LinearRing in polygon (first = outer)
-        if not outer_coords:
-            lrs = findall_local(poly_el, 'LinearRing')
-            if lrs:
-                coords_el = find_first_local(lrs[0], 'coordinates')
-                coords = parse_coordinates_text(coords_el.text if coords_el is not None else None)
-                if coords:
-                    outer_coords = [(lon, lat) if alt is None else (lon, lat, alt) for lon, lat, alt in coords]
-                # any subsequent LinearRing -> holes
-                for lr in lrs[1:]:
-                    coords_el = find_first_local(lr, 'coordinates')
-                    coords = parse_coordinates_text(coords_el.text if coords_el is not None else None)
-                    if coords:
-                        holes.append([(lon, lat) if alt is None else (lon, lat, alt) for lon, lat, alt in coords])
+        outer = next((r for r in rings if r['role'] == 'outer'), None)
+        if outer is not None and outer['coords']:
+            outer_coords = _local_coords(outer['coords'])
+        holes: List[List] = [_local_coords(r['coords']) for r in rings if r['role'] == 'inner' and r['coords']]
+
+        # Fallback: if no explicit outer boundary, any LinearRing in polygon (first = outer)
+        if not outer_coords and rings:
+            if rings[0]['coords']:
+                outer_coords = _local_coords(rings[0]['coords'])
+            # any subsequent LinearRing -> holes
+            holes.extend(_local_coords(r['coords']) for r in rings[1:] if r['coords'])
 
         if outer_coords:
-            geoms.append({'type': 'Polygon', 'coordinates': {'outer': outer_coords, 'holes': holes}})
+            self._polygons.append({'type': 'Polygon', 'coordinates': {'outer': outer_coords, 'holes': holes}})
+
+    def geometries(self) -> List[Dict]:
+        return self._points + self._linestrings + self._polygons
+
+    def result(self) -> Dict:
+        return {'name': self.name, 'description': self.description, 'geometries': self.geometries()}
+
 
-    # MultiGeometry is naturally handled because findall_local searches nested geometry elements.
+def _feed_element(builder: _PlacemarkBuilder, el: ET.Element) -> None:
+    """Replay an already-parsed element subtree into a builder as start/end events."""
+    if not isinstance(el.tag, str):
+        return
+    tag = strip_namespace(el.tag)
+    if tag in GEOMETRY_START_TAGS:
+        builder.start(tag)
+    for child in el:
+        _feed_element(builder, child)
+    if tag in PLACEMARK_END_TAGS:
+        builder.end(tag, el.text)
 
-    return geoms
 
+def geometry_from_placemark(placemark_el: ET.Element) -> List[Dict]:
+    """
+    Extract geometry dicts from a Placemark element.
+    Each geometry dict: {'type': 'Point'|'LineString'|'Polygon', 'coordinates': ...}
+    """
+    builder = _PlacemarkBuilder()
+    for child in placemark_el:
+        _feed_element(builder, child)
+    # MultiGeometry is naturally handled because nested geometry elements get their own frames.
+    return builder.geometries()
+
+
+class _LenientUtf8Reader:
+    """
+    File-like wrapper decoding a binary stream incrementally as UTF-8, replacing
+    undecodable bytes (like the .decode('utf-8', 'replace') of whole uploads), so
+    one stray byte doesn't fail the parse. read() returns UTF-8 bytes for lxml,
+    or str for the stdlib parser.
+    """
 
-def extract_placemarks(kml_text: str) -> List[Dict]:
-    """Parse KML text and return list of placemarks with name, description, and geometries."""
+    def __init__(self, raw: BinaryIO, as_bytes: bool):
+        self._raw = raw
+        self._as_bytes = as_bytes
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    def read(self, size: int = -1):
+        while True:
+            data = self._raw.read(size)
+            text = self._decoder.decode(data, final=not data)
+            # a chunk holding only part of a multi-byte character decodes to '';
+            # returning that would look like end of file to the parser
+            if text or not data:
+                return text.encode('utf-8') if self._as_bytes else text
+
+
+def _iterparse(kml_source: Union[str, BinaryIO], use_lxml: bool = HAVE_LXML):
+    """Yield (event, element) start/end pairs for a KML string or binary file object."""
+    if not isinstance(kml_source, str):
+        # file objects are read incrementally, decoded the same lenient way as strings
+        if use_lxml:
+            return ET.iterparse(_LenientUtf8Reader(kml_source, as_bytes=True), events=('start', 'end'),
+                                encoding='utf-8')
+        return StdET.iterparse(_LenientUtf8Reader(kml_source, as_bytes=False), events=('start', 'end'))
+    kml_text = kml_source
+    if use_lxml:
+        # libxml2 only reads bytes; the text is already decoded, so re-encode as
+        # UTF-8 and override whatever encoding the XML declaration claims
+        return ET.iterparse(io.BytesIO(kml_text.encode('utf-8')), events=('start', 'end'),
+                            encoding='utf-8')
     # parse string (avoid encoding confusion by passing str)
-    root = ET.fromstring(kml_text)
-    placemark_elements = findall_local(root, 'Placemark')
+    return StdET.iterparse(io.StringIO(kml_text), events=('start', 'end'))
+
+
+def extract_placemarks(kml_source: Union[str, BinaryIO]) -> List[Dict]:
+    """
+    Parse KML and return list of placemarks with name, description, and geometries.
+
+    kml_source is either KML text or a binary file object (e.g. a KMZ entry
+    opened with ZipFile.open). The document is streamed once with iterparse;
+    each Placemark is cleared and detached as soon as it has been emitted, so
+    memory stays bounded by the largest single Placemark rather than the whole file.
+
+    lxml keeps libxml2's default limits on untrusted input; a document it rejects
+    (e.g. a single coordinates text over 10 MB) is parsed again with the stdlib
+    parser, whose expat limits are looser, rather than lifting them for every upload.
+    """
+    if not HAVE_LXML:
+        return _extract_placemarks(_iterparse(kml_source, use_lxml=False))
+    start = None if isinstance(kml_source, str) else kml_source.tell()
+    try:
+        return _extract_placemarks(_iterparse(kml_source))
+    except ET.XMLSyntaxError:
+        if start is not None:
+            kml_source.seek(start)
+        return _extract_placemarks(_iterparse(kml_source, use_lxml=False))
+
+
+def _extract_placemarks(events) -> List[Dict]:
+    """Collects the placemarks from an iterparse event stream, see extract_placemarks."""
     result = []
-    for pm in placemark_elements:
-        name_el = find_first_local(pm, 'name')
-        desc_el = find_first_local(pm, 'description')
-        name = name_el.text.strip() if (name_el is not None and name_el.text) else None
-        description = desc_el.text.strip() if (desc_el is not None and desc_el.text) else None
-        geometries = geometry_from_placemark(pm)
-        result.append({'name': name, 'description': description, 'geometries': geometries})
+    builder: Optional[_PlacemarkBuilder] = None
+    open_elements: List[ET.Element] = []
+    for event, elem in events:
+        tag = elem.tag.rpartition('}')[2]  # strip_namespace, inlined for the per-element loop
+        if event == 'start':
+            open_elements.append(elem)
+            if tag == 'Placemark':
+                builder = _PlacemarkBuilder()
+            elif builder is not None and tag in GEOMETRY_START_TAGS:
+                builder.start(tag)
+            continue
+
+        open_elements.pop()
+        if builder is None:
+            continue
+        if tag == 'Placemark':
+            result.append(builder.result())
+            builder = None
+            elem.clear()
+            if open_elements:
+                open_elements[-1].remove(elem)
+        elif tag in PLACEMARK_END_TAGS:
+            builder.end(tag, elem.text)
     return result
 
 
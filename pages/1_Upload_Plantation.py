@@ -1,32 +1,63 @@
 import streamlit as st
 import folium
 from streamlit_folium import st_folium
-from shapely.geometry import Point, Polygon, LineString
 import io
 import json
+import orjson
+import multiprocessing
+import re
+import sys
 import zipfile
 import os
+from concurrent.futures import ProcessPoolExecutor
 from kml_parser import extract_placemarks
+from geo_utils import build_measured_geometry, total_bounds
+from plantation_data import DATA_FILE, data_file_version
 
-DATA_FILE = "plantations.geojson"
+# Uploads with at least this many geometries are built/measured in a process pool
+PARALLEL_MIN_GEOMETRIES = 2000
 
 st.set_page_config(page_title="Upload Plantations", layout="wide")
 
 
 
-def save_plantations_to_geojson(new_plantations):
-    """Appends new plantation data to the GeoJSON file."""
-    if not os.path.exists(DATA_FILE):
-        geojson_data = {"type": "FeatureCollection", "features": []}
-    else:
+def read_geojson():
+    """Reads the GeoJSON file, returning an empty FeatureCollection if it is missing or unreadable."""
+    if os.path.exists(DATA_FILE):
         try:
-            with open(DATA_FILE, 'r') as f:
-                geojson_data = json.load(f)
+            with open(DATA_FILE, 'rb') as f:
+                return orjson.loads(f.read())
         except (IOError, json.JSONDecodeError):
-            geojson_data = {"type": "FeatureCollection", "features": []}
+            pass
+    return {"type": "FeatureCollection", "features": []}
+
+def get_saved_names_index():
+    """
+    Returns {'version', 'names', 'can_append'} for the GeoJSON file, kept in session state.
+
+    The file is only re-read when its version (mtime, size) differs from the one
+    recorded after this session's last read or save, i.e. when it was changed from elsewhere.
+    """
+    version = data_file_version()
+    index = st.session_state.get('saved_names_index')
+    if index is None or index['version'] != version:
+        geojson_data = read_geojson()
+        index = {
+            "version": version,
+            "names": {feature['properties'].get('name') for feature in geojson_data['features']},
+            # New features can be spliced in before the closing brackets only if
+            # "features" is the last key of the collection
+            "can_append": version is not None and list(geojson_data)[-1:] == ['features'],
+        }
+        st.session_state['saved_names_index'] = index
+    return index
 
-    existing_names = {feature['properties'].get('name') for feature in geojson_data['features']}
+def save_plantations_to_geojson(new_plantations):
+    """Appends new plantation data to the GeoJSON file."""
+    index = get_saved_names_index()
+    existing_names = index['names']
 
+    new_features = []
     for p in new_plantations:
         if p.get('name') in existing_names:
             st.warning(f"Plantation '{p.get('name')}' already exists in the database. Skipping.")
@@ -44,70 +75,115 @@ def save_plantations_to_geojson(new_plantations):
             "geometry": geom.__geo_interface__,
             "properties": properties
         }
-        geojson_data['features'].append(feature)
-    
-    with open(DATA_FILE, 'w') as f:
-        json.dump(geojson_data, f, indent=2)
-
-def calculate_area(geom):
-    if isinstance(geom, Polygon): return geom.area * 111319.9**2 
-    return 0
-
-def calculate_length(geom):
-    if isinstance(geom, (LineString, Polygon)): return geom.length * 111319.9
-    return 0
+        new_features.append(feature)
+
+    if not new_features:
+        return
+    # Append in place when possible rather than re-encoding and rewriting every feature
+    if not (index['can_append'] and append_features_to_geojson(new_features)):
+        geojson_data = read_geojson()
+        geojson_data['features'].extend(new_features)
+        with open(DATA_FILE, 'wb') as f:
+            f.write(orjson.dumps(geojson_data, option=orjson.OPT_INDENT_2))
+        index['can_append'] = list(geojson_data)[-1:] == ['features']
+
+    existing_names.update(feature['properties'].get('name') for feature in new_features)
+    index['version'] = data_file_version()
+
+def append_features_to_geojson(features):
+    """
+    Appends features to the FeatureCollection in DATA_FILE without rewriting it.
+
+    Only the closing brackets at the end of the file are replaced. Returns False
+    (leaving the file untouched) if the file doesn't end like a FeatureCollection
+    written by this page, i.e. with its "features" array closed by "]}".
+    """
+    with open(DATA_FILE, 'r+b') as f:
+        size = f.seek(0, os.SEEK_END)
+        tail_start = max(0, size - 4096)
+        f.seek(tail_start)
+        tail = f.read().rstrip()
+        if not tail.endswith(b'}'):
+            return False
+        tail = tail[:-1].rstrip()
+        if not tail.endswith(b']'):
+            return False
+        tail = tail[:-1].rstrip()
+        if not tail:
+            return False
+        # tail now ends with the last feature's "}" or the array's opening "["
+        is_empty = tail.endswith(b'[')
+        # Keep the file's line endings (CRLF if it was last saved on Windows)
+        newline = b"\r\n" if b"\r\n" in tail else b"\n"
+
+        # Indent each feature to its nesting level inside the collection
+        body = (b"," + newline).join(
+            newline.join(b"    " + line for line in orjson.dumps(feature, option=orjson.OPT_INDENT_2).split(b"\n"))
+            for feature in features
+        )
+        f.seek(tail_start + len(tail))
+        f.truncate()
+        f.write((newline if is_empty else b"," + newline) + body + newline + b"  ]" + newline + b"}")
+    return True
+
+DESCRIPTION_LINE_BREAK = re.compile(r'<br>|\n')
+
+def parse_description(description):
+    """Parses "key: value" lines (separated by <br> or newlines) from a placemark description."""
+    details = {}
+    if not description: return details
+    for line in DESCRIPTION_LINE_BREAK.split(description):
+        key, sep, value = line.partition(':')
+        if sep:
+            details[sys.intern(key.strip().lower().replace(' ', '_'))] = sys.intern(value.strip())
+    return details
 
 def process_kml(uploaded_file):
-    def parse_description(description):
-        details = {}
-        if not description: return details
-        description = description.replace('<br>', '\n')
-        for line in description.split('\n'):
-            if ':' in line:
-                key, value = line.split(':', 1)
-                details[key.strip().lower().replace(' ', '_')] = value.strip()
-        return details
-
     try:
-        uploaded_file.seek(0)
-        kml_content = ''
+        # Parse straight from the upload / KMZ entry instead of copying it into memory first
         if uploaded_file.name.lower().endswith('.kmz'):
-            with zipfile.ZipFile(io.BytesIO(uploaded_file.read()), 'r') as z:
+            uploaded_file.seek(0)
+            with zipfile.ZipFile(uploaded_file, 'r') as z:
                 kml_name = next((n for n in z.namelist() if n.lower().endswith('.kml')), None)
-                if kml_name: kml_content = z.read(kml_name).decode('utf-8', 'replace')
+                if not kml_name or not z.getinfo(kml_name).file_size:
+                    st.warning("Could not read KML content.")
+                    return []
+                with z.open(kml_name) as kml_file:
+                    placemarks = extract_placemarks(kml_file)
         else:
-            kml_content = uploaded_file.read().decode('utf-8', 'replace')
-
-        if not kml_content:
-            st.warning("Could not read KML content.")
-            return []
+            if not uploaded_file.seek(0, io.SEEK_END):
+                st.warning("Could not read KML content.")
+                return []
+            uploaded_file.seek(0)
+            placemarks = extract_placemarks(uploaded_file)
 
-        placemarks = extract_placemarks(kml_content)
-        features = []
+        jobs = []
         for placemark in placemarks:
+            attributes = parse_description(placemark.get('description', ''))
             for geom_dict in placemark.get('geometries', []):
-                try:
-                    geom_type = geom_dict.get('type')
-                    if geom_type == 'Polygon':
-                        coords = geom_dict['coordinates']
-                        shapely_geom = Polygon([(c[0], c[1]) for c in coords['outer']], 
-                                               [[(c[0], c[1]) for c in hole] for hole in coords['holes']])
-                    elif geom_type == 'LineString':
-                        shapely_geom = LineString([(c[0], c[1]) for c in geom_dict['coordinates']])
-                    elif geom_type == 'Point':
-                        coords = geom_dict['coordinates']
-                        shapely_geom = Point(coords[0], coords[1])
-                    else: continue
-                    
-                    attributes = parse_description(placemark.get('description', ''))
-                    feature = {"name": placemark.get('name') or "N/A"}
-                    feature.update(attributes)
-                    feature["geometry"] = shapely_geom
-                    feature["area_sq_m"] = calculate_area(shapely_geom)
-                    feature["length_m"] = calculate_length(shapely_geom)
-                    features.append(feature)
-                except Exception as e:
-                    st.warning(f"Skipping invalid geometry in '{placemark.get('name', 'N/A')}': {e}")
+                jobs.append((placemark, attributes, geom_dict))
+        geom_dicts = [geom_dict for _, _, geom_dict in jobs]
+        if len(geom_dicts) >= PARALLEL_MIN_GEOMETRIES:
+            # Only worth the worker start-up cost for bulk uploads; spawn avoids forking
+            # the multi-threaded Streamlit server process.
+            with ProcessPoolExecutor(mp_context=multiprocessing.get_context('spawn')) as executor:
+                results = list(executor.map(build_measured_geometry, geom_dicts, chunksize=64))
+        else:
+            results = map(build_measured_geometry, geom_dicts)
+
+        features = []
+        for (placemark, attributes, _), (shapely_geom, area, length, error) in zip(jobs, results):
+            if error is not None:
+                st.warning(f"Skipping invalid geometry in '{placemark.get('name', 'N/A')}': {error}")
+                continue
+            if shapely_geom is None: continue
+
+            feature = {"name": placemark.get('name') or "N/A"}
+            feature.update(attributes)
+            feature["geometry"] = shapely_geom
+            feature["area_sq_m"] = area
+            feature["length_m"] = length
+            features.append(feature)
         return features
     except Exception as e:
         st.error(f"Error processing file: {e}")
@@ -154,15 +230,13 @@ if uploaded_file and upload_button:
         if new_plantations:
             st.session_state.session_plantations.extend(new_plantations)
             
-            min_lon, min_lat, max_lon, max_lat = float('inf'), float('inf'), float('-inf'), float('-inf')
-            for p in st.session_state.session_plantations:
-                b = p['geometry'].bounds
-                min_lon, min_lat, max_lon, max_lat = min(min_lon, b[0]), min(min_lat, b[1]), max(max_lon, b[2]), max(max_lat, b[3])
-            
-            if max_lon > min_lon:
-                st.session_state.map_view_bounds = [[min_lat, min_lon], [max_lat, max_lon]]
-            elif min_lon != float('inf'):
-                st.session_state.map_view_bounds = [[min_lat - 0.01, min_lon - 0.01], [max_lat + 0.01, max_lon + 0.01]]
+            bounds = total_bounds([p['geometry'] for p in st.session_state.session_plantations])
+            if bounds is not None:
+                min_lon, min_lat, max_lon, max_lat = bounds
+                if max_lon > min_lon:
+                    st.session_state.map_view_bounds = [[min_lat, min_lon], [max_lat, max_lon]]
+                else:
+                    st.session_state.map_view_bounds = [[min_lat - 0.01, min_lon - 0.01], [max_lat + 0.01, max_lon + 0.01]]
 
             st.success(f"Added {len(new_plantations)} plantation(s) to the current session for review.")
             st.rerun()
@@ -186,9 +260,17 @@ if st.session_state.session_plantations:
     if st.session_state.map_view_bounds:
         m.fit_bounds(st.session_state.map_view_bounds)
 
-    for p in st.session_state.session_plantations:
-        popup_html = f"<h4>{p.get('name', 'N/A')}</h4>"
-        folium.GeoJson(p['geometry'], popup=folium.Popup(popup_html, max_width=300), tooltip=p['name']).add_to(m)
+    # One FeatureCollection (a single Leaflet layer) for all pending plantations
+    features = [
+        {"type": "Feature", "geometry": p['geometry'].__geo_interface__,
+         "properties": {"name": p.get('name', 'N/A'), "popup_html": f"<h4>{p.get('name', 'N/A')}</h4>"}}
+        for p in st.session_state.session_plantations
+    ]
+    folium.GeoJson(
+        {"type": "FeatureCollection", "features": features},
+        popup=folium.GeoJsonPopup(fields=["popup_html"], labels=False, localize=False, max_width=300),
+        tooltip=folium.GeoJsonTooltip(fields=["name"], labels=False)
+    ).add_to(m)
     
     # Add a layer control to the map
     folium.LayerControl().add_to(m)
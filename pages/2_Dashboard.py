@@ -1,73 +1,114 @@
 import streamlit as st
-import os
 import folium
 from streamlit_folium import st_folium
-from shapely.geometry import shape, mapping
-import json
+from geo_utils import bounds_extent
+from plantation_data import (CACHED_VERSIONS, DATA_FILE, data_file_version, load_plantation_bounds,
+                             load_plantation_centroids, load_plantation_index, load_plantations_frame,
+                             load_plantations_from_geojson)
+import orjson
+import numpy as np
+import shapely
 import pandas as pd
-import os
-
-DATA_FILE = "plantations.geojson"
 
 st.set_page_config(page_title="Plantation Dashboard", layout="wide")
 
+# Map selections with at least this many plantations are culled to the current viewport
+MAP_CULL_MIN_FEATURES = 2000
+
 
 st.markdown("<h1 style='text-align: center;'>&#128202; PLANTATION DASHBOARD</h1>", unsafe_allow_html=True)
 st.markdown("<p style='text-align: center;'>View, filter, and manage all uploaded plantation data.</p>", unsafe_allow_html=True)
 
-def load_plantations_from_geojson():
-    """Loads all plantation data from the GeoJSON file."""
-    if not os.path.exists(DATA_FILE):
-        return []
-    
-    try:
-        with open(DATA_FILE, 'r') as f:
-            geojson_data = json.load(f)
-        
-        plantations = []
-        for feature in geojson_data['features']:
-            properties = feature['properties']
-            geom = shape(feature['geometry'])
-            properties['geometry'] = geom
-            if 'area_sq_m' not in properties:
-                properties['area_sq_m'] = geom.area * 111319.9**2 if geom.geom_type == 'Polygon' else 0
-            if 'length_m' not in properties:
-                 properties['length_m'] = geom.length * 111319.9 if geom.geom_type in ['LineString', 'Polygon'] else 0
-            plantations.append(properties)
-        return plantations
-    except (IOError, json.JSONDecodeError) as e:
-        st.error(f"Error loading data file: {e}")
-        return []
-
-def get_unique_attributes(plantations):
-    if not plantations: return {}
-    df = pd.DataFrame(plantations)
-    potential_cols = [col for col in df.columns if col not in ['geometry', 'name', 'description', 'area_sq_m', 'length_m']]
-    return {col: sorted(df[col].dropna().unique().tolist()) for col in potential_cols if df[col].nunique() > 1}
+@st.cache_data(show_spinner=False, max_entries=CACHED_VERSIONS)
+def build_popup_html(version, _plantations):
+    """Builds the map popup HTML of every plantation, once per version of the data file."""
+    popup_hidden_keys = {'name', 'geometry', 'area_sq_m', 'length_m'}
+    popup_labels = {}  # attribute key -> row label, built once per distinct key
+    popups = []
+    for p in _plantations:
+        parts = [
+            "<h4>Plantation Details</h4><table>",
+            f"<tr><td><b>Name</b></td><td>{p.get('name', 'N/A')}</td></tr>",
+        ]
+        for key, value in p.items():
+            if key not in popup_hidden_keys:
+                label = popup_labels.get(key)
+                if label is None:
+                    label = popup_labels[key] = key.replace('_', ' ').title()
+                parts.append(f"<tr><td><b>{label}</b></td><td>{value}</td></tr>")
+
+        area_ha = (p.get('area_sq_m', 0) / 10000)
+        length_km = (p.get('length_m', 0) / 1000)
+        if area_ha > 0:
+            parts.append(f"<tr><td><b>Area</b></td><td>{area_ha:.2f} ha</td></tr>")
+        if length_km > 0:
+            parts.append(f"<tr><td><b>Perimeter/Length</b></td><td>{length_km:.3f} km</td></tr>")
+
+        parts.append("</table>")
+        popups.append("".join(parts))
+    return popups
+
+@st.cache_resource(show_spinner=False, max_entries=16)
+def build_feature_collection(version, mask_key, _plantations, _indices):
+    """
+    Builds the map FeatureCollection of the plantations at _indices.
+
+    Keyed on the data file version and the packed filter mask, so reruns that
+    keep the same selection (map interactions, table selection) reuse it. The
+    Folium Map itself can't be cached: st_folium mutates it while rendering.
+    """
+    popups = build_popup_html(version, _plantations)
+    features = []
+    for i in _indices:
+        p = _plantations[i]
+        features.append({
+            "type": "Feature",
+            "geometry": p['geometry'],
+            "properties": {"name": p.get('name', 'N/A'), "popup_html": popups[i]}
+        })
+    return {"type": "FeatureCollection", "features": features}
+
+@st.cache_resource(show_spinner=False, max_entries=CACHED_VERSIONS)
+def lowercase_columns(version):
+    """
+    Lowercased Arrow string copies of the details columns for text search, per data
+    file version. Filled in as columns are searched; shared, so only ever added to.
+    """
+    return {}
+
+@st.cache_data(show_spinner=False, max_entries=1)
+def read_data_file(version):
+    """Reads the raw data file for the full download, once per version of the file."""
+    with open(DATA_FILE, "rb") as fp:
+        return fp.read()
 
 def handle_selection():
     """Callback to update map center and zoom based on table selection."""
-    if 'plantation_editor' in st.session_state and st.session_state.plantation_editor['selection']['rows']:
+    if 'plantation_editor' in st.session_state and st.session_state.plantation_editor.selection.rows:
         try:
-            selected_row_index = st.session_state.plantation_editor['selection']['rows'][0]
+            selected_row_index = st.session_state.plantation_editor.selection.rows[0]
             
             # Retrieve the data needed for the calculation from session state
             original_indices = st.session_state.get('original_indices')
-            filtered_plantations = st.session_state.get('filtered_plantations_for_callback')
 
-            if original_indices is not None and filtered_plantations is not None:
+            if original_indices is not None:
                 # Map the editor's selected row index back to the original plantation list index
-                original_plantation_index = original_indices.iloc[selected_row_index]
-                
-                selected_plantation_geom = filtered_plantations[original_plantation_index]['geometry']
-                centroid = selected_plantation_geom.centroid
-                
-                st.session_state['map_center'] = [centroid.y, centroid.x]
+                original_plantation_index = original_indices[selected_row_index]
+
+                # Centroids are precomputed for all plantations in one vectorised GEOS call,
+                # from the data version the table's row indices came from
+                centroids = load_plantation_centroids(st.session_state.get('original_indices_version'))
+                st.session_state['map_center'] = centroids[original_plantation_index].tolist()
                 st.session_state['map_zoom'] = 15
+                # Centre on the plantation rather than the last reported view or the selection's extent
+                st.session_state.pop('dashboard_map_view', None)
+                st.session_state['map_focus_selection'] = True
         except (KeyError, IndexError) as e:
             st.error(f"An error occurred while handling the selection: {e}")
 
-all_plantations = load_plantations_from_geojson()
+# Version of the data file this run reads; every loader and per-version cache below is keyed on it
+data_version = data_file_version()
+all_plantations = load_plantations_from_geojson(data_version)
 
 if 'map_center' not in st.session_state:
     st.session_state['map_center'] = [15.3173, 75.7139]
@@ -99,23 +140,22 @@ st.markdown("---")
 # --- Filtering Logic ---
 st.subheader("Plantations in Database")
 
-# Create a full DataFrame of all plantations to generate filter options
-df_all = pd.DataFrame(all_plantations)
+# Columnar table of all plantation attributes (row i is all_plantations[i]), to generate filter options
+df_all = load_plantations_frame(data_version)
 if not df_all.empty:
-    details_all = pd.DataFrame()
-    details_all['Plantation Name'] = df_all.get('name', pd.Series(dtype='str'))
+    # Gather the columns first and build the frame in one go, rather than inserting them one at a time
     other_attrs = [col for col in df_all.columns if col not in ['name', 'geometry', 'area_sq_m', 'length_m', 'description']]
+    details_columns = {'Plantation Name': df_all.get('name', pd.Series(index=df_all.index, dtype='str'))}
     for attr in other_attrs:
-        details_all[attr.replace('_', ' ').title()] = df_all[attr]
-    details_all['Area (Hectares)'] = (pd.to_numeric(df_all.get('area_sq_m', 0)) / 10000).round(2)
-    details_all['Perimeter/Length (km)'] = (pd.to_numeric(df_all.get('length_m', 0)) / 1000).round(3)
+        details_columns[attr.replace('_', ' ').title()] = df_all[attr]
+    details_columns['Area (Hectares)'] = (df_all['area_sq_m'] / 10000).round(2)
+    details_columns['Perimeter/Length (km)'] = (df_all['length_m'] / 1000).round(3)
+    details_all = pd.DataFrame(details_columns, copy=False)
 
 # Initialize session state for filters if it doesn't exist
 if 'adv_filters' not in st.session_state:
     st.session_state.adv_filters = {}
 
-filtered_display_df = details_all.copy()
-
 with st.expander("Filter Plantations", expanded=True):
     with st.form("advanced_filter_form"):
         num_filter_cols = 3
@@ -127,7 +167,10 @@ with st.expander("Filter Plantations", expanded=True):
             cols = st.columns(num_filter_cols)
             for i, col_name in enumerate(group):
                 with cols[i]:
-                    if pd.api.types.is_object_dtype(details_all[col_name].dtype) and details_all[col_name].nunique() < 20:
+                    if isinstance(details_all[col_name].dtype, pd.CategoricalDtype):
+                        default_val = st.session_state.adv_filters.get(col_name, [])
+                        form_selections[col_name] = st.multiselect(f"By {col_name}", options=details_all[col_name].cat.categories, key=f"multi_{col_name}", default=default_val)
+                    elif pd.api.types.is_object_dtype(details_all[col_name].dtype) and details_all[col_name].nunique() < 20:
                         unique_vals = details_all[col_name].dropna().unique()
                         default_val = st.session_state.adv_filters.get(col_name, [])
                         form_selections[col_name] = st.multiselect(f"By {col_name}", options=unique_vals, key=f"multi_{col_name}", default=default_val)
@@ -145,17 +188,25 @@ with st.expander("Filter Plantations", expanded=True):
             st.session_state.adv_filters = form_selections
             st.rerun()
 
-# Apply advanced filters from session state
+# Apply advanced filters from session state: AND all predicates into one boolean
+# mask over the full table, then slice once
+filter_mask = np.ones(len(details_all), dtype=bool)
 for col_name, value in st.session_state.adv_filters.items():
     if value:
+        column = details_all[col_name]
         if isinstance(value, list):
-            filtered_display_df = filtered_display_df[filtered_display_df[col_name].isin(value)]
+            filter_mask &= column.isin(value).to_numpy()
         elif isinstance(value, str):
-            filtered_display_df = filtered_display_df[filtered_display_df[col_name].astype(str).str.contains(value, case=False, na=False)]
+            search_columns = lowercase_columns(data_version)
+            search_column = search_columns.get(col_name)
+            if search_column is None:
+                search_column = search_columns[col_name] = column.astype('string[pyarrow]').str.lower()
+            filter_mask &= search_column.str.contains(value.lower(), regex=False, na=False).to_numpy(dtype=bool)
         elif isinstance(value, tuple):
-            min_val, max_val = float(details_all[col_name].min()), float(details_all[col_name].max())
+            min_val, max_val = float(column.min()), float(column.max())
             if value != (min_val, max_val):
-                filtered_display_df = filtered_display_df[filtered_display_df[col_name].between(value[0], value[1])]
+                filter_mask &= column.between(value[0], value[1]).to_numpy()
+filtered_display_df = details_all[filter_mask]
 
 # Create the list of plantation dicts for the map from the filtered DataFrame
 filtered_indices = filtered_display_df.index
@@ -165,7 +216,31 @@ st.markdown("---")
 st.subheader("Map View")
 
 # --- Map Display ---
-m = folium.Map(location=st.session_state['map_center'], zoom_start=st.session_state['map_zoom'], tiles="OpenStreetMap")
+# Large selections only send the browser the plantations inside the viewport the
+# map last reported, found through the cached STRtree; the view is kept as it was.
+# That view is only reused while the selection it was reported for is unchanged: a
+# new selection is drawn in full and the map refitted to it.
+filter_key = (data_version, np.packbits(filter_mask).tobytes())
+map_mask = filter_mask
+map_indices = filtered_indices.to_numpy()
+map_view = st.session_state.get('dashboard_map_view') or {}
+view_bounds = None
+if len(map_indices) >= MAP_CULL_MIN_FEATURES and st.session_state.get('dashboard_map_view_key') == filter_key:
+    view_bounds = map_view.get('bounds')
+if view_bounds and view_bounds['_southWest']['lat'] is not None and map_view.get('center'):
+    south_west, north_east = view_bounds['_southWest'], view_bounds['_northEast']
+    visible = load_plantation_index(data_version).query(
+        shapely.box(south_west['lng'], south_west['lat'], north_east['lng'], north_east['lat'])
+    )
+    map_mask = np.zeros_like(filter_mask)
+    map_mask[visible] = True
+    map_mask &= filter_mask
+    map_indices = np.flatnonzero(map_mask)
+    view_center = [map_view['center']['lat'], map_view['center']['lng']]
+    m = folium.Map(location=view_center, zoom_start=map_view['zoom'], tiles="OpenStreetMap")
+else:
+    view_bounds = None
+    m = folium.Map(location=st.session_state['map_center'], zoom_start=st.session_state['map_zoom'], tiles="OpenStreetMap")
 
 # Add satellite tile layer for toggling
 folium.TileLayer(
@@ -174,43 +249,40 @@ folium.TileLayer(
     attr='Esri'
 ).add_to(m)
 
-if filtered_plantations:
-    min_lon, min_lat, max_lon, max_lat = float('inf'), float('inf'), float('-inf'), float('-inf')
-    for p in filtered_plantations:
-        b = p['geometry'].bounds
-        min_lon, min_lat, max_lon, max_lat = min(min_lon, b[0]), min(min_lat, b[1]), max(max_lon, b[2]), max(max_lat, b[3])
-    
-    if max_lon > min_lon:
-        m.fit_bounds([[min_lat, min_lon], [max_lat, max_lon]])
-
-    for p in filtered_plantations:
-        popup_html = "<h4>Plantation Details</h4><table>"
-        popup_html += f"<tr><td><b>Name</b></td><td>{p.get('name', 'N/A')}</td></tr>"
-        
-        for key, value in p.items():
-            if key not in ['name', 'geometry', 'area_sq_m', 'length_m']:
-                popup_html += f"<tr><td><b>{key.replace('_', ' ').title()}</b></td><td>{value}</td></tr>"
-
-        area_ha = (p.get('area_sq_m', 0) / 10000)
-        length_km = (p.get('length_m', 0) / 1000)
-        if area_ha > 0:
-            popup_html += f"<tr><td><b>Area</b></td><td>{area_ha:.2f} ha</td></tr>"
-        if length_km > 0:
-            popup_html += f"<tr><td><b>Perimeter/Length</b></td><td>{length_km:.3f} km</td></tr>"
-            
-        popup_html += "</table>"
-        
-        folium.GeoJson(
-            p['geometry'], 
-            popup=folium.Popup(popup_html, max_width=300), 
-            tooltip=p['name'],
-            control=False  # This line prevents it from appearing in the layer control
-        ).add_to(m)
+# Identifies the set of plantations drawn on the map, for the caches below
+map_key = (data_version, np.packbits(map_mask).tobytes())
+
+# Set by handle_selection for the rerun after a table row is picked
+focus_selection = st.session_state.pop('map_focus_selection', False)
+if filtered_plantations and view_bounds is None and not focus_selection:
+    # The extent only changes with the selection, so reruns that keep it (map and
+    # table interactions) reuse the one stored in session state
+    if st.session_state.get('map_bounds_key') != map_key:
+        st.session_state['map_bounds'] = bounds_extent(load_plantation_bounds(data_version)[map_indices])
+        st.session_state['map_bounds_key'] = map_key
+    bounds = st.session_state['map_bounds']
+    if bounds is not None:
+        min_lon, min_lat, max_lon, max_lat = bounds
+        if max_lon > min_lon:
+            m.fit_bounds([[min_lat, min_lon], [max_lat, max_lon]])
+
+if len(map_indices):
+    # All plantations go into one FeatureCollection (a single Leaflet layer); each
+    # feature carries its own popup HTML as a property.
+    feature_collection = build_feature_collection(*map_key, all_plantations, map_indices)
+
+    folium.GeoJson(
+        feature_collection,
+        popup=folium.GeoJsonPopup(fields=["popup_html"], labels=False, localize=False, max_width=300),
+        tooltip=folium.GeoJsonTooltip(fields=["name"], labels=False),
+        control=False  # This line prevents it from appearing in the layer control
+    ).add_to(m)
 
 # Add a layer control to the map to toggle layers
 folium.LayerControl().add_to(m)
 
-st_folium(m, width='100%', height=600)
+st.session_state['dashboard_map_view'] = st_folium(m, width='100%', height=600)
+st.session_state['dashboard_map_view_key'] = filter_key
 
 st.markdown("---")
 
@@ -229,7 +301,7 @@ with col_download:
             if geom:
                 feature = {
                     "type": "Feature",
-                    "geometry": mapping(geom),
+                    "geometry": geom,
                     "properties": properties
                 }
                 features.append(feature)
@@ -238,7 +310,7 @@ with col_download:
             "type": "FeatureCollection",
             "features": features
         }
-        filtered_geojson_str = json.dumps(geojson_collection, indent=2)
+        filtered_geojson_str = orjson.dumps(geojson_collection, option=orjson.OPT_INDENT_2)
 
         st.download_button(
             label="📥 Download Filtered Data (GeoJSON)",
@@ -252,14 +324,16 @@ with col_download:
 if not filtered_display_df.empty:
     # Store the necessary data in session state for the callback to work with the filtered table
     st.session_state['original_indices'] = filtered_display_df.index
-    st.session_state['filtered_plantations_for_callback'] = all_plantations # Pass the full list
+    st.session_state['original_indices_version'] = data_version
     
-    st.data_editor(
+    # Read-only table; picking a row centres the map on that plantation
+    st.dataframe(
         filtered_display_df,
         key="plantation_editor",
         use_container_width=True,
         hide_index=True,
-        disabled=True  # Make the table read-only
+        on_select=handle_selection,
+        selection_mode="single-row"
     )
 else:
     st.info("No data matches the table filters.")
@@ -267,11 +341,10 @@ else:
 st.markdown("---")
 st.subheader("Plantations Data")
 st.markdown("Download the complete plantations data in GeoJSON format.")
-with open(DATA_FILE, "rb") as fp:
-    st.download_button(
-        label="Download GeoJSON",
-        data=fp,
-        file_name="plantations.geojson",
-        mime="application/json",
-        use_container_width=True
-    )
\ No newline at end of file
+st.download_button(
+    label="Download GeoJSON",
+    data=read_data_file(data_version),
+    file_name="plantations.geojson",
+    mime="application/json",
+    use_container_width=True
+)
\ No newline at end of file
@@ -1,36 +1,61 @@
 import streamlit as st
+import numpy as np
 import pandas as pd
-import json
-import os
-from shapely.geometry import shape
-import altair as alt
+from plantation_data import data_file_version, load_plantations_frame
 
-DATA_FILE = "plantations.geojson"
+# Filter selections whose chart aggregations stay cached (4 bar charts and 2 donuts per selection)
+CACHED_FILTER_SELECTIONS = 8
 
-def create_grouped_bar_chart(data, x_axis, y_axis, color_group, x_title, y_title, color_title, subheader):
+
+@st.cache_data(show_spinner=False, max_entries=4 * CACHED_FILTER_SELECTIONS)
+def count_groups(filters_key, x_axis, color_group, _data):
+    """
+    Counts the rows per (x_axis, color_group) group, over the rows that have both set.
+
+    _data is the filtered table; it isn't hashed, filters_key (data file version
+    plus the filter selections) identifies it instead.
+    """
+    chart_data = _data.dropna(subset=[x_axis, color_group])
+    chart_data = chart_data[chart_data[x_axis] != '']
+    return chart_data.groupby([x_axis, color_group], observed=True).size().reset_index(name='count')
+
+@st.cache_data(show_spinner=False, max_entries=2 * CACHED_FILTER_SELECTIONS)
+def sum_groups(filters_key, category_col, value_col, _data):
+    """Sums value_col per category_col group of the filtered table _data, identified by filters_key."""
+    chart_data = _data.dropna(subset=[category_col, value_col])
+    chart_data = chart_data[chart_data[category_col] != '']
+    return chart_data.groupby(category_col, observed=True)[value_col].sum().reset_index()
+
+def create_grouped_bar_chart(data, filters_key, x_axis, y_axis, color_group, x_title, y_title, color_title, subheader):
     """Helper function to create a grouped bar chart."""
     st.subheader(subheader)
     required_cols = [col for col in [x_axis, color_group] if col is not None]
     if not all(col in data.columns for col in required_cols):
         st.warning(f"Missing required data columns for this chart. Please ensure the uploaded data has '{', '.join(required_cols)}' attributes.")
         return
-    chart_data = data.dropna(subset=required_cols)
-    if x_axis in chart_data.columns:
-        chart_data = chart_data[chart_data[x_axis] != '']
-    if chart_data.empty:
+    # Counted on the server so the chart gets one row per (x, color) group, not one per
+    # plantation; reruns with the same filters reuse the counts
+    agg_data = count_groups(filters_key, x_axis, color_group, data)
+    if agg_data.empty:
         st.info(f"No data available to display for '{subheader}'.")
         return
-    chart = alt.Chart(chart_data).mark_bar().encode(
-        x=alt.X(f'{x_axis}:N', title=x_title, sort='-y', axis=alt.Axis(labelAngle=0)),
-        y=alt.Y(f'count({y_axis}):Q', title=y_title),
-        color=alt.Color(f'{color_group}:N', title=color_title),
-        tooltip=[alt.Tooltip(f'{x_axis}:N', title=x_title),
-                 alt.Tooltip(f'{color_group}:N', title=color_title),
-                 alt.Tooltip('count():Q', title=y_title)]
-    ).interactive()
-    st.altair_chart(chart, use_container_width=True)
-
-def create_donut_chart(data, category_col, value_col, subheader, title=''):
+    # Plain Vega-Lite spec (what the Altair chain compiled to), skipping Altair's
+    # schema validation. No scale-bound selection: pan/zoom does nothing useful on
+    # a nominal x axis, it only adds hit-testing on every mouse move
+    spec = {
+        "mark": {"type": "bar"},
+        "encoding": {
+            "x": {"field": x_axis, "type": "nominal", "title": x_title, "sort": "-y", "axis": {"labelAngle": 0}},
+            "y": {"field": "count", "type": "quantitative", "title": y_title},
+            "color": {"field": color_group, "type": "nominal", "title": color_title},
+            "tooltip": [{"field": x_axis, "type": "nominal", "title": x_title},
+                        {"field": color_group, "type": "nominal", "title": color_title},
+                        {"field": "count", "type": "quantitative", "title": y_title}],
+        },
+    }
+    st.vega_lite_chart(agg_data, spec, use_container_width=True)
+
+def create_donut_chart(data, filters_key, category_col, value_col, subheader, title=''):
     """Helper function to create a donut chart."""
     st.subheader(subheader)
 
@@ -38,49 +63,23 @@ def create_donut_chart(data, category_col, value_col, subheader, title=''):
         st.warning(f"Missing required data columns for this chart. Please ensure the uploaded data has '{category_col}' and '{value_col}' attributes.")
         return
 
-    data[value_col] = pd.to_numeric(data[value_col], errors='coerce')
-    chart_data = data.dropna(subset=[category_col, value_col])
-    chart_data = chart_data[chart_data[category_col] != '']
+    agg_data = sum_groups(filters_key, category_col, value_col, data)
 
-    if chart_data.empty:
+    if agg_data.empty:
         st.info(f"No data available to display for '{subheader}'.")
         return
 
-    agg_data = chart_data.groupby(category_col)[value_col].sum().reset_index()
-
-    chart = alt.Chart(agg_data).mark_arc(innerRadius=60, outerRadius=120).encode(
-        theta=alt.Theta(field=value_col, type="quantitative", title="Number of Seedlings"),
-        color=alt.Color(field=category_col, type="nominal", title="Scheme"),
-        tooltip=[alt.Tooltip(field=category_col, type="nominal", title="Scheme"),
-                 alt.Tooltip(field=value_col, type="quantitative", title="Total Seedlings", format=',')]
-    ).properties(
-        title=title
-    )
-    st.altair_chart(chart, use_container_width=True)
-
-def load_plantations_from_geojson():
-    """Loads all plantation data from the GeoJSON file."""
-    if not os.path.exists(DATA_FILE):
-        return []
-    
-    try:
-        with open(DATA_FILE, 'r') as f:
-            geojson_data = json.load(f)
-        
-        plantations = []
-        for feature in geojson_data['features']:
-            properties = feature['properties']
-            geom = shape(feature['geometry'])
-            properties['geometry'] = geom
-            if 'area_sq_m' not in properties:
-                properties['area_sq_m'] = geom.area * 111319.9**2 if geom.geom_type == 'Polygon' else 0
-            if 'length_m' not in properties:
-                 properties['length_m'] = geom.length * 111319.9 if geom.geom_type in ['LineString', 'Polygon'] else 0
-            plantations.append(properties)
-        return plantations
-    except (IOError, json.JSONDecodeError) as e:
-        st.error(f"Error loading data file: {e}")
-        return []
+    spec = {
+        "mark": {"type": "arc", "innerRadius": 60, "outerRadius": 120},
+        "encoding": {
+            "theta": {"field": value_col, "type": "quantitative", "title": "Number of Seedlings"},
+            "color": {"field": category_col, "type": "nominal", "title": "Scheme"},
+            "tooltip": [{"field": category_col, "type": "nominal", "title": "Scheme"},
+                        {"field": value_col, "type": "quantitative", "title": "Total Seedlings", "format": ","}],
+        },
+        "title": title,
+    }
+    st.vega_lite_chart(agg_data, spec, use_container_width=True)
 
 def main():
     """Main function to run the Streamlit page."""
@@ -89,15 +88,14 @@ def main():
     st.markdown("<h1 style='text-align: center;'>&#128200; PLANTATION ANALYTICS</h1>", unsafe_allow_html=True)
     st.markdown("<p style='text-align: center;'>Explore insights and trends from the plantation data.</p>", unsafe_allow_html=True)
 
-    all_plantations = load_plantations_from_geojson()
+    # Read once so the table and the chart caches keyed on filters_key share one version
+    data_version = data_file_version()
+    df = load_plantations_frame(data_version)
 
-    if not all_plantations:
+    if df.empty:
         st.info("No plantation data found. Please upload a KML/KMZ file on the 'Upload Plantation' page.")
         st.stop()
 
-    df = pd.DataFrame(all_plantations)
-    df['area_ha'] = (df['area_sq_m'] / 10000).round(2)
-    df['length_km'] = (df['length_m'] / 1000).round(3)
 
     st.markdown("---")
 
@@ -118,9 +116,13 @@ def main():
         st.subheader("Filters")
         
         def get_unique_values(column_name):
-            if column_name in df.columns:
-                return sorted(df[column_name].dropna().unique())
-            return []
+            if column_name not in df.columns:
+                return []
+            column = df[column_name]
+            if isinstance(column.dtype, pd.CategoricalDtype):
+                # Categories are the sorted distinct values, fixed when the table was loaded
+                return column.cat.categories.tolist()
+            return sorted(column.dropna().unique())
 
         schemes = get_unique_values('scheme')
         years = get_unique_values('year')
@@ -139,17 +141,17 @@ def main():
             selected_ranges = st.multiselect('Range', ranges)
 
     
-    filtered_df = df.copy()
-    if selected_schemes and 'scheme' in df.columns:
-        filtered_df = filtered_df[filtered_df['scheme'].isin(selected_schemes)]
-    if selected_years and 'year' in df.columns:
-        filtered_df = filtered_df[filtered_df['year'].isin(selected_years)]
-    if selected_plantation_types and 'plantation_type' in df.columns:
-        filtered_df = filtered_df[filtered_df['plantation_type'].isin(selected_plantation_types)]
-    if selected_divisions and 'division' in df.columns:
-        filtered_df = filtered_df[filtered_df['division'].isin(selected_divisions)]
-    if selected_ranges and 'range' in df.columns:
-        filtered_df = filtered_df[filtered_df['range'].isin(selected_ranges)]
+    # AND every active multiselect into one boolean mask, then slice the table once
+    filter_mask = np.ones(len(df), dtype=bool)
+    for column_name, selected in [('scheme', selected_schemes), ('year', selected_years),
+                                  ('plantation_type', selected_plantation_types),
+                                  ('division', selected_divisions), ('range', selected_ranges)]:
+        if selected and column_name in df.columns:
+            filter_mask &= df[column_name].isin(selected).to_numpy()
+    filtered_df = df[filter_mask]
+    # Identifies filtered_df for the cached chart aggregations
+    filters_key = (data_version, tuple(selected_schemes), tuple(selected_years),
+                   tuple(selected_plantation_types), tuple(selected_divisions), tuple(selected_ranges))
 
     if filtered_df.empty:
         st.warning("No data matches the current filter settings.")
@@ -158,17 +160,16 @@ def main():
     st.header("Key Metrics")
     col1, col2, col3 = st.columns(3)
     col1.metric("Total Plantations", f"{len(filtered_df)}")
-    col2.metric("Total Area (Hectares)", f"{filtered_df['area_ha'].sum():,.2f}")
+    col2.metric("Total Area (Hectares)", f"{(filtered_df['area_sq_m'] / 10000).round(2).sum():,.2f}")
     if 'number_of_seedlings' in filtered_df.columns:
-        total_seedlings = pd.to_numeric(filtered_df['number_of_seedlings'], errors='coerce').fillna(0).sum()
+        # Already numeric (coerced when the table is loaded); sum() skips missing values
+        total_seedlings = filtered_df['number_of_seedlings'].sum()
         col3.metric("Total Seedlings", f"{total_seedlings:,.0f}")
     else:
         col3.metric("Total Seedlings", "N/A")
 
     st.markdown("---")
 
-    chart_df = filtered_df.drop(columns=['geometry'])
-
     row1_col1, row1_col2 = st.columns([1,2])
     st.markdown("<hr>", unsafe_allow_html=True)
     row2_col1, row2_col2 = st.columns([2,1])
@@ -177,14 +178,16 @@ def main():
 
     with row1_col1:
         create_donut_chart(
-            data=chart_df,
+            data=filtered_df,
+            filters_key=filters_key,
             category_col='scheme',
             value_col='number_of_seedlings',
             subheader='1. No of Plants Planted in Schemes'
         )
     with row1_col2:
         create_grouped_bar_chart(
-            data=chart_df,
+            data=filtered_df,
+            filters_key=filters_key,
             x_axis='scheme',
             y_axis='name',
             color_group='year',
@@ -195,7 +198,8 @@ def main():
         )
     with row2_col1:
         create_grouped_bar_chart(
-            data=chart_df,
+            data=filtered_df,
+            filters_key=filters_key,
             x_axis='plantation_type',
             y_axis='name',
             color_group='division',
@@ -206,14 +210,16 @@ def main():
         )
     with row2_col2:
         create_donut_chart(
-            data=chart_df,
+            data=filtered_df,
+            filters_key=filters_key,
             category_col='plantation_type',
             value_col='number_of_seedlings',
             subheader='4. No of Plants in Plantation'
         )
     with row3_col1:
         create_grouped_bar_chart(
-            data=chart_df,
+            data=filtered_df,
+            filters_key=filters_key,
             x_axis='year',
             y_axis='name',
             color_group='plantation_type',
@@ -224,7 +230,8 @@ def main():
         )
     with row3_col2:
         create_grouped_bar_chart(
-            data=chart_df,
+            data=filtered_df,
+            filters_key=filters_key,
             x_axis='division',
             y_axis='name',
             color_group='range',
@@ -0,0 +1,223 @@
+"""
+plantation_data.py
+
+Loading of the plantations GeoJSON store, shared by the app pages.
+"""
+
+import json
+import os
+import sys
+
+import numpy as np
+import orjson
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+import streamlit as st
+from shapely.geometry import shape
+
+from geo_utils import calculate_area, calculate_length
+
+DATA_FILE = "plantations.geojson"
+# Columnar copy of the attribute table, tagged with the DATA_FILE version it was built from
+ATTRIBUTES_FILE = "plantations.parquet"
+# Parquet schema metadata key holding that version
+SIDECAR_VERSION_KEY = b"plantations_geojson_version"
+# Low-cardinality attributes the pages filter and group on, held as pandas categoricals
+CATEGORY_COLUMNS = ['scheme', 'division', 'range', 'plantation_type', 'year']
+# Attributes that may be stored as text (e.g. taken from a KML description) but are counts
+NUMERIC_COLUMNS = ['number_of_seedlings']
+# Versions of DATA_FILE each _load_* cache keeps: the current one plus the previous one,
+# still used by sessions mid-run when an upload lands; older ones are evicted, not leaked
+CACHED_VERSIONS = 2
+
+
+def data_file_version():
+    """
+    Returns (mtime, size) of DATA_FILE, or None when there is no data file yet. The
+    caches below are keyed on it, so they are invalidated by any rewrite or append,
+    even one within the mtime's resolution.
+
+    A page should read it once per run and pass it to every loader it calls, so all
+    the data it gets (and the page's own caches keyed on it) come from one version.
+    """
+    try:
+        stat = os.stat(DATA_FILE)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime, stat.st_size
+
+
+def load_plantations_from_geojson(version=None):
+    """Loads all plantation data from the GeoJSON file, as of version (default: now)."""
+    if version is None:
+        version = data_file_version()
+    if version is None:
+        return []
+    # Keyed on the file's version so the cache is invalidated whenever the file is rewritten
+    return _load_plantations(DATA_FILE, version)
+
+
+def load_plantations_frame(version=None):
+    """
+    Loads the plantation attributes as a DataFrame, one column per property.
+
+    Rows are in the same order as load_plantations_from_geojson(); geometries
+    are left out, the pages only need them for the map.
+    """
+    if version is None:
+        version = data_file_version()
+    if version is None:
+        return pd.DataFrame()
+    return _load_plantations_frame(DATA_FILE, version, ATTRIBUTES_FILE)
+
+
+def load_plantation_bounds(version=None):
+    """
+    Loads the (min_lon, min_lat, max_lon, max_lat) of every plantation as an
+    (N, 4) float array, rows in the same order as load_plantations_from_geojson().
+    """
+    if version is None:
+        version = data_file_version()
+    if version is None:
+        return np.empty((0, 4))
+    return _load_plantation_bounds(DATA_FILE, version)
+
+
+def load_plantation_centroids(version=None):
+    """
+    Loads the (lat, lon) centroid of every plantation as an (N, 2) float array,
+    rows in the same order as load_plantations_from_geojson().
+    """
+    if version is None:
+        version = data_file_version()
+    if version is None:
+        return np.empty((0, 2))
+    return _load_plantation_centroids(DATA_FILE, version)
+
+
+def load_plantation_index(version=None):
+    """
+    Loads an STRtree over the plantations' bounding boxes; query() results are row
+    positions in load_plantations_from_geojson().
+    """
+    if version is None:
+        version = data_file_version()
+    if version is None:
+        return shapely.STRtree([])
+    return _load_plantation_index(DATA_FILE, version)
+
+
+def _to_float(value):
+    """Converts a stored measurement to float, NaN if it is null or not a number."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+@st.cache_resource(show_spinner=False, max_entries=CACHED_VERSIONS)
+def _load_plantations(path, version):
+    """
+    Parses the GeoJSON file into plantation dicts.
+
+    Cached as a resource: every page and session gets the same list rather than
+    an unpickled copy on each rerun, so callers must not modify it.
+
+    'geometry' holds the feature's GeoJSON geometry mapping as stored; Shapely
+    geometries are only built where they are needed (missing area/length here,
+    map bounds on the dashboard).
+    """
+    try:
+        with open(path, 'rb') as f:
+            geojson_data = orjson.loads(f.read())
+        
+        plantations = []
+        for feature in geojson_data['features']:
+            # Repeated values (division, range, scheme, ...) share one interned str
+            properties = {key: sys.intern(value) if isinstance(value, str) else value
+                          for key, value in feature['properties'].items()}
+            properties['geometry'] = feature['geometry']
+            if 'area_sq_m' not in properties or 'length_m' not in properties:
+                geom = shape(feature['geometry'])
+                properties.setdefault('area_sq_m', calculate_area(geom))
+                properties.setdefault('length_m', calculate_length(geom))
+            # Typed once here so the DataFrame columns come out float64 without coercion
+            properties['area_sq_m'] = _to_float(properties['area_sq_m'])
+            properties['length_m'] = _to_float(properties['length_m'])
+            plantations.append(properties)
+        return plantations
+    except (IOError, json.JSONDecodeError) as e:
+        st.error(f"Error loading data file: {e}")
+        return []
+
+
+@st.cache_resource(show_spinner=False, max_entries=CACHED_VERSIONS)
+def _load_plantations_frame(path, version, sidecar_path):
+    """
+    Builds the columnar attribute table once per version of the file. Like the
+    plantation list it is shared, not copied, and must not be modified in place.
+
+    The table is read from the Parquet sidecar when that was built from this exact
+    version of the GeoJSON, skipping the JSON parse on a cold start; otherwise it
+    is rebuilt from the GeoJSON and the sidecar rewritten. Comparing versions
+    rather than mtimes also catches a GeoJSON restored with an older mtime.
+    """
+    version_tag = orjson.dumps(list(version))
+    if os.path.exists(sidecar_path):
+        try:
+            table = pq.read_table(sidecar_path)
+            if (table.schema.metadata or {}).get(SIDECAR_VERSION_KEY) == version_tag:
+                return table.to_pandas()
+        except (OSError, pa.ArrowException):
+            pass  # unreadable sidecar: rebuild it below
+
+    plantations = _load_plantations(path, version)
+    if not plantations:
+        return pd.DataFrame()
+    frame = pd.DataFrame.from_records(plantations, exclude=['geometry'])
+    for column in CATEGORY_COLUMNS:
+        if column in frame.columns:
+            frame[column] = frame[column].astype('category')
+    for column in NUMERIC_COLUMNS:
+        if column in frame.columns:
+            # Smallest integer type that fits when every value is a whole number (float64 otherwise)
+            frame[column] = pd.to_numeric(frame[column], errors='coerce', downcast='integer')
+    try:
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+        table = table.replace_schema_metadata({**table.schema.metadata, SIDECAR_VERSION_KEY: version_tag})
+        pq.write_table(table, sidecar_path)
+    except (OSError, pa.ArrowException):
+        # The sidecar is only a cache; columns Arrow can't type (mixed str/int
+        # values) or a read-only directory just mean parsing the GeoJSON next time
+        pass
+    return frame
+
+
+@st.cache_resource(show_spinner=False, max_entries=CACHED_VERSIONS)
+def _load_plantation_geometries(path, version):
+    """Builds the Shapely geometries once per version of the file, as an object array for the vectorised shapely functions."""
+    plantations = _load_plantations(path, version)
+    return np.array([shape(p['geometry']) for p in plantations], dtype=object)
+
+
+@st.cache_data(show_spinner=False, max_entries=CACHED_VERSIONS)
+def _load_plantation_bounds(path, version):
+    """Computes the per-plantation bounds once per version of the file."""
+    return shapely.bounds(_load_plantation_geometries(path, version))
+
+
+@st.cache_data(show_spinner=False, max_entries=CACHED_VERSIONS)
+def _load_plantation_centroids(path, version):
+    """Computes the per-plantation centroids once per version of the file."""
+    centroids = shapely.centroid(_load_plantation_geometries(path, version))
+    return np.column_stack([shapely.get_y(centroids), shapely.get_x(centroids)])
+
+
+@st.cache_resource(show_spinner=False, max_entries=CACHED_VERSIONS)
+def _load_plantation_index(path, version):
+    """Builds the spatial index once per version of the file (kept as a shared resource, not copied)."""
+    bounds = _load_plantation_bounds(path, version)
+    # Plantations with empty geometries get a None box, which STRtree skips
+    return shapely.STRtree(shapely.box(bounds[:, 0], bounds[:, 1], bounds[:, 2], bounds[:, 3]))